@@ -2,22 +2,28 @@ import asyncio
 import datetime
 import logging
 import os
+import signal
 import time
+from dataclasses import dataclass
 from html import escape
 from pathlib import Path
 from urllib.parse import quote
 
 from dotenv import load_dotenv
 from telegram import ReplyKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (ApplicationBuilder, CommandHandler, ConversationHandler,
                           ContextTypes, MessageHandler, filters)
 
-from db import Chat, MonitoredUser, init_db
-from rating_scraper import get_rating
+from db import (Chat, MonitoredUser, PendingNotification, get_sweep_state, init_db,
+                migrate_db)
+from rating_index import RatingIndex
+from rating_scraper import get_rating, shutdown_parser_pool, start_parser_pool
 
 load_dotenv()
 
 SessionLocal = init_db()
+RATING_INDEX = RatingIndex()
 
 CHOOSING_ACTION, AWAITING_USERNAME = range(2)
 MENU_CHOICE_REGEX = r"^(Проверка рейтинга|Пользователи на мониторинге|Добавить на мониторинг|Удалить с мониторинга)$"
@@ -56,6 +62,13 @@ BOT_DESCRIPTION = (
 DAILY_STATS = {"checked": 0, "changed": 0, "errors": 0}
 DAILY_STATS_LOCK = asyncio.Lock()
 
+SWEEP_INTERVAL = 600
+SWEEP_LOCK = asyncio.Lock()
+SWEEP_STOPPING = asyncio.Event()
+SWEEP_DRAIN_TIMEOUT = float(os.getenv("SWEEP_DRAIN_TIMEOUT", "5"))
+SWEEP_FETCHES: set[asyncio.Task] = set()
+_SHUTDOWN_TASKS: set[asyncio.Task] = set()
+
 
 def _format_full_name(first_name: str | None, last_name: str | None) -> str:
     parts = [p for p in [first_name, last_name] if p]
@@ -120,11 +133,26 @@ async def _log_action(application, user, chat: Chat | None, action: str, detail:
     await _send_channel_message(application, text)
 
 
+def _save_daily_stats() -> None:
+    session = SessionLocal()
+    try:
+        state = get_sweep_state(session)
+        state.checked = DAILY_STATS["checked"]
+        state.changed = DAILY_STATS["changed"]
+        state.errors = DAILY_STATS["errors"]
+        session.commit()
+    except Exception as exc:
+        logger.error("daily_stats_save_failed: error=%s", exc)
+    finally:
+        session.close()
+
+
 async def _record_daily_stats(checked: int, changed: int, errors: int) -> None:
     async with DAILY_STATS_LOCK:
         DAILY_STATS["checked"] += checked
         DAILY_STATS["changed"] += changed
         DAILY_STATS["errors"] += errors
+        _save_daily_stats()
 
 
 async def _send_daily_summary(context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -133,6 +161,7 @@ async def _send_daily_summary(context: ContextTypes.DEFAULT_TYPE) -> None:
         DAILY_STATS["checked"] = 0
         DAILY_STATS["changed"] = 0
         DAILY_STATS["errors"] = 0
+        _save_daily_stats()
     await _send_channel_message(
         context.application,
         f"Сводка за сутки: проверено {stats['checked']}, "
@@ -141,10 +170,93 @@ async def _send_daily_summary(context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+def _process_uptime() -> float | None:
+    try:
+        with open("/proc/self/stat") as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _load_daily_stats() -> None:
+    session = SessionLocal()
+    try:
+        state = get_sweep_state(session)
+        DAILY_STATS["checked"] = state.checked
+        DAILY_STATS["changed"] = state.changed
+        DAILY_STATS["errors"] = state.errors
+        session.commit()
+    finally:
+        session.close()
+
+
+def _first_sweep_delay() -> float:
+    session = SessionLocal()
+    try:
+        state = get_sweep_state(session)
+        if state.cursor is not None:
+            return 0
+        if state.finished_at is None:
+            return SWEEP_INTERVAL
+        elapsed = time.time() - state.finished_at
+        return min(SWEEP_INTERVAL, max(0, SWEEP_INTERVAL - elapsed))
+    finally:
+        session.close()
+
+
+async def _wait_sweep_idle() -> None:
+    async with SWEEP_LOCK:
+        pass
+
+
+async def _drain_and_stop(application) -> None:
+    try:
+        await asyncio.wait_for(_wait_sweep_idle(), SWEEP_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        for fetch in tuple(SWEEP_FETCHES):
+            fetch.cancel()
+        await _wait_sweep_idle()
+    application.stop_running()
+
+
+def _request_shutdown(application) -> None:
+    if SWEEP_STOPPING.is_set():
+        return
+    SWEEP_STOPPING.set()
+    task = asyncio.get_running_loop().create_task(_drain_and_stop(application))
+    _SHUTDOWN_TASKS.add(task)
+    task.add_done_callback(_SHUTDOWN_TASKS.discard)
+
+
 async def _post_init(application) -> None:
+    migrate_db(SessionLocal)
+    RATING_INDEX.load(SessionLocal)
+    _load_daily_stats()
+    await _send_pending_notifications(application)
+    application.job_queue.run_repeating(
+        check_all_ratings,
+        interval=SWEEP_INTERVAL,
+        first=_first_sweep_delay(),
+    )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, _request_shutdown, application)
+        except NotImplementedError:
+            pass
     if not LOG_CHANNEL_ID:
         return
-    await _send_channel_message(application, "Логи: бот запущен")
+    elapsed = _process_uptime()
+    if elapsed is None:
+        await _send_channel_message(application, "Логи: бот запущен")
+        return
+    await _send_channel_message(application, f"Логи: бот запущен за {elapsed:.2f} с")
+
+
+async def _post_shutdown(application) -> None:
+    shutdown_parser_pool()
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -349,6 +461,7 @@ async def handle_username(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             mu = MonitoredUser(chat_id=chat.id, username=username, last_rating=rating if rating is not None else None)
             session.add(mu)
             session.commit()
+            RATING_INDEX.add(username, chat.chat_id, rating)
             await update.message.reply_text("Пользователь добавлен на мониторинг")
             await _log_action(
                 context.application,
@@ -369,6 +482,7 @@ async def handle_username(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 return CHOOSING_ACTION
             session.delete(mu)
             session.commit()
+            RATING_INDEX.remove(username, chat.chat_id)
             await update.message.reply_text("Пользователь удален из мониторинга")
             await _log_action(
                 context.application,
@@ -383,79 +497,330 @@ async def handle_username(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return CHOOSING_ACTION
 
 
-async def check_all_ratings(context: ContextTypes.DEFAULT_TYPE) -> None:
-    application = context.application
+SWEEP_QUEUE_SIZE = int(os.getenv("SWEEP_QUEUE_SIZE", "32"))
+SWEEP_FETCH_WORKERS = int(os.getenv("SWEEP_FETCH_WORKERS", "4"))
+SWEEP_CHECKPOINT_EVERY = 20
+
+_SWEEP_DONE = object()
+
+
+@dataclass(slots=True)
+class RatingEvent:
+    username: str
+    seq: int = 0
+    chat_ids: tuple[str, ...] = ()
+    old_rating: int | None = None
+    new_rating: int | None = None
+    error: str | None = None
+    cursor: str | None = None
+    changed: bool = False
+    notify: tuple[tuple[str, int], ...] = ()
+
+
+def _load_chats(chat_ids) -> list[Chat]:
+    session = SessionLocal()
+    try:
+        return session.query(Chat).filter(Chat.chat_id.in_(chat_ids)).all()
+    finally:
+        session.close()
+
+
+async def _send_notification(application, session, pending: PendingNotification) -> None:
+    user_link = _hackerlab_link(pending.username)
+    try:
+        await application.bot.send_message(
+            chat_id=pending.chat_id,
+            text=f"Рейтинг пользователя {user_link} изменился: {pending.old_rating} -> {pending.new_rating}",
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+        )
+    except Exception as exc:
+        retryable = not isinstance(exc, (Forbidden, BadRequest))
+        await _record_daily_stats(0, 0, 1)
+        chats = _load_chats((pending.chat_id,))
+        await _log_error(
+            application,
+            None,
+            chats[0] if chats else None,
+            "monitoring",
+            f"не удалось отправить уведомление для {user_link}",
+        )
+        if retryable:
+            return
+    session.query(PendingNotification).filter_by(id=pending.id).delete()
+    session.commit()
+
+
+async def _send_pending_notifications(application) -> None:
     session = SessionLocal()
-    checked = 0
-    changed = 0
-    errors = 0
     try:
-        users = session.query(MonitoredUser).all()
-        for user in users:
-            checked += 1
+        for pending in session.query(PendingNotification).order_by(PendingNotification.id).all():
+            await _send_notification(application, session, pending)
+    finally:
+        session.close()
+
+
+class _ErrorLogger:
+    def __init__(self, application) -> None:
+        self.application = application
+
+    async def handle(self, event: RatingEvent) -> None:
+        if event.error is None:
+            return
+        for chat in _load_chats(event.chat_ids):
+            await _log_error(
+                self.application,
+                None,
+                chat,
+                "monitoring",
+                f"{event.error} для {_hackerlab_link(event.username)}",
+            )
+
+    async def close(self) -> None:
+        pass
+
+
+class _RatingWriter:
+    def __init__(self, notify_queue: asyncio.Queue) -> None:
+        self.session = SessionLocal(expire_on_commit=False)
+        self.notify_queue = notify_queue
+        self.uncommitted = 0
+        self.checked = 0
+        self.changed = 0
+        self.errors = 0
+
+    async def _commit(self) -> None:
+        async with DAILY_STATS_LOCK:
+            state = get_sweep_state(self.session)
+            state.checked = DAILY_STATS["checked"] + self.checked
+            state.changed = DAILY_STATS["changed"] + self.changed
+            state.errors = DAILY_STATS["errors"] + self.errors
             try:
-                new_rating = await get_rating(user.username)
+                self.session.commit()
             except Exception:
-                errors += 1
-                await _log_error(
-                    application,
-                    None,
-                    user.chat,
-                    "monitoring",
-                    f"ошибка получения рейтинга для {_hackerlab_link(user.username)}",
-                )
-                continue
-            if new_rating is None:
-                errors += 1
-                await _log_error(
-                    application,
-                    None,
-                    user.chat,
-                    "monitoring",
-                    f"не удалось получить рейтинг для {_hackerlab_link(user.username)}",
+                self.session.rollback()
+                raise
+            DAILY_STATS["checked"] = state.checked
+            DAILY_STATS["changed"] = state.changed
+            DAILY_STATS["errors"] = state.errors
+        self.uncommitted = 0
+        self.checked = 0
+        self.changed = 0
+        self.errors = 0
+
+    async def handle(self, event: RatingEvent) -> None:
+        pending = []
+        self.checked += 1
+        if event.error is not None:
+            self.errors += 1
+        if event.changed:
+            self.changed += 1
+            self.session.query(MonitoredUser).filter_by(username=event.username).update(
+                {MonitoredUser.last_rating: event.new_rating}
+            )
+            pending = [
+                PendingNotification(
+                    chat_id=chat_id,
+                    username=event.username,
+                    old_rating=old_rating,
+                    new_rating=event.new_rating,
                 )
-                continue
-            old_rating = user.last_rating
-            if old_rating is None:
-                user.last_rating = new_rating
-                session.commit()
-                changed += 1
-                continue
-            if new_rating == old_rating:
-                continue
-            user.last_rating = new_rating
-            session.commit()
-            changed += 1
-            if new_rating >= old_rating:
-                continue
-            user_link = _hackerlab_link(user.username)
+                for chat_id, old_rating in event.notify
+            ]
+            self.session.add_all(pending)
+        get_sweep_state(self.session).cursor = event.cursor
+        self.uncommitted += 1
+        if event.changed or self.uncommitted >= SWEEP_CHECKPOINT_EVERY:
+            await self._commit()
+        for item in pending:
+            self.session.expunge(item)
+        if event.changed:
+            entry = RATING_INDEX.get(event.username)
+            if entry is not None:
+                entry.last_rating = event.new_rating
+                entry.baselines = None
+        for item in pending:
+            await self.notify_queue.put(item)
+
+    async def close(self) -> None:
+        try:
+            await self._commit()
+        finally:
+            self.session.close()
+            await self.notify_queue.put(_SWEEP_DONE)
+
+
+def _load_sweep_cursor() -> str | None:
+    session = SessionLocal()
+    try:
+        return get_sweep_state(session).cursor
+    finally:
+        session.close()
+
+
+def _finish_sweep() -> None:
+    session = SessionLocal()
+    try:
+        state = get_sweep_state(session)
+        state.cursor = None
+        state.finished_at = time.time()
+        session.commit()
+    finally:
+        session.close()
+
+
+async def _sweep_source(out_queue: asyncio.Queue, workers: int, cursor: str | None) -> None:
+    try:
+        seq = 0
+        username = RATING_INDEX.next_after(cursor)
+        while username is not None and not SWEEP_STOPPING.is_set():
+            await out_queue.put((seq, username))
+            seq += 1
+            username = RATING_INDEX.next_after(username)
+    finally:
+        for _ in range(workers):
+            await out_queue.put(_SWEEP_DONE)
+
+
+async def _sweep_fetch(in_queue: asyncio.Queue, out_queue: asyncio.Queue) -> None:
+    while True:
+        item = await in_queue.get()
+        if item is _SWEEP_DONE:
+            await out_queue.put(_SWEEP_DONE)
+            return
+        if SWEEP_STOPPING.is_set():
+            continue
+        seq, username = item
+        fetch = asyncio.ensure_future(get_rating(username))
+        SWEEP_FETCHES.add(fetch)
+        try:
+            new_rating = await fetch
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            continue
+        except Exception:
+            await out_queue.put(RatingEvent(username, seq, error="ошибка получения рейтинга"))
+            continue
+        finally:
+            SWEEP_FETCHES.discard(fetch)
+        if new_rating is None:
+            await out_queue.put(RatingEvent(username, seq, error="не удалось получить рейтинг"))
+            continue
+        await out_queue.put(RatingEvent(username, seq, new_rating=new_rating))
+
+
+async def _sweep_diff(
+    in_queue: asyncio.Queue,
+    out_queues: list[asyncio.Queue],
+    workers: int,
+    cursor: str | None,
+) -> None:
+    finished = 0
+    next_seq = 0
+    completed: dict[int, str] = {}
+    while finished < workers:
+        event = await in_queue.get()
+        if event is _SWEEP_DONE:
+            finished += 1
+            continue
+        completed[event.seq] = event.username
+        while next_seq in completed:
+            cursor = completed.pop(next_seq)
+            next_seq += 1
+        entry = RATING_INDEX.get(event.username)
+        if entry is None:
+            continue
+        event.chat_ids = entry.chat_ids
+        event.old_rating = entry.last_rating
+        event.cursor = cursor
+        if event.error is None and (event.new_rating != event.old_rating or entry.baselines):
+            event.changed = True
+            event.notify = tuple(
+                (chat_id, old_rating)
+                for chat_id in entry.chat_ids
+                if (old_rating := entry.baseline(chat_id)) is not None and event.new_rating < old_rating
+            )
+        for queue in out_queues:
+            await queue.put(event)
+    for queue in out_queues:
+        await queue.put(_SWEEP_DONE)
+
+
+async def _sweep_consume(in_queue: asyncio.Queue, consumer) -> None:
+    try:
+        while True:
+            event = await in_queue.get()
+            if event is _SWEEP_DONE:
+                return
             try:
-                message = f"Рейтинг пользователя {user_link} изменился: {old_rating} -> {new_rating}"
-                await application.bot.send_message(
-                    chat_id=user.chat.chat_id,
-                    text=message,
-                    parse_mode="HTML",
-                    disable_web_page_preview=True,
-                )
-            except Exception:
-                errors += 1
-                await _log_error(
-                    application,
-                    None,
-                    user.chat,
-                    "monitoring",
-                    f"не удалось отправить уведомление для {_hackerlab_link(user.username)}",
+                await consumer.handle(event)
+            except Exception as exc:
+                logger.error(
+                    "sweep_consumer_failed: consumer=%s username=%s error=%s",
+                    type(consumer).__name__,
+                    event.username,
+                    exc,
                 )
+    finally:
+        await consumer.close()
+
+
+async def _sweep_notify(in_queue: asyncio.Queue, application) -> None:
+    session = SessionLocal()
+    try:
+        while True:
+            pending = await in_queue.get()
+            if pending is _SWEEP_DONE:
+                return
+            try:
+                await _send_notification(application, session, pending)
+            except Exception as exc:
+                session.rollback()
+                logger.error("sweep_notify_failed: username=%s error=%s", pending.username, exc)
     finally:
         session.close()
-    await _record_daily_stats(checked, changed, errors)
+
+
+async def check_all_ratings(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if SWEEP_STOPPING.is_set() or SWEEP_LOCK.locked():
+        return
+    async with SWEEP_LOCK:
+        application = context.application
+        await _send_pending_notifications(application)
+        cursor = _load_sweep_cursor()
+        notify_queue: asyncio.Queue = asyncio.Queue(maxsize=SWEEP_QUEUE_SIZE)
+        consumers = [
+            _RatingWriter(notify_queue),
+            _ErrorLogger(application),
+        ]
+        workers = max(1, SWEEP_FETCH_WORKERS)
+        targets: asyncio.Queue = asyncio.Queue(maxsize=SWEEP_QUEUE_SIZE)
+        fetched: asyncio.Queue = asyncio.Queue(maxsize=SWEEP_QUEUE_SIZE)
+        fan_out = [asyncio.Queue(maxsize=SWEEP_QUEUE_SIZE) for _ in consumers]
+        await asyncio.gather(
+            _sweep_source(targets, workers, cursor),
+            *(_sweep_fetch(targets, fetched) for _ in range(workers)),
+            _sweep_diff(fetched, fan_out, workers, cursor),
+            *(_sweep_consume(queue, consumer) for queue, consumer in zip(fan_out, consumers)),
+            _sweep_notify(notify_queue, application),
+        )
+        if not SWEEP_STOPPING.is_set():
+            _finish_sweep()
 
 
 def main() -> None:
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("BOT_TOKEN is not set")
-    application = ApplicationBuilder().token(token).post_init(_post_init).build()
+    start_parser_pool()
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
@@ -468,9 +833,8 @@ def main() -> None:
         fallbacks=[CommandHandler("start", start)],
     )
     application.add_handler(conv_handler)
-    application.job_queue.run_repeating(check_all_ratings, interval=600, first=600)
     application.job_queue.run_daily(_send_daily_summary, time=datetime.time(hour=13, minute=0))
-    application.run_polling()
+    application.run_polling(stop_signals=None)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,13 @@
 import os
 from pathlib import Path
 
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, create_engine, text
+from sqlalchemy import Column, Float, Integer, String, ForeignKey, UniqueConstraint, create_engine, text
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
 
 Base = declarative_base()
 
+SCHEMA_VERSION = 3
+
 
 class Chat(Base):
     __tablename__ = "chats"
@@ -27,6 +29,35 @@ class MonitoredUser(Base):
     __table_args__ = (UniqueConstraint("chat_id", "username", name="chat_username_uc"),)
 
 
+class SweepState(Base):
+    __tablename__ = "sweep_state"
+    id = Column(Integer, primary_key=True)
+    cursor = Column(String)
+    finished_at = Column(Float)
+    checked = Column(Integer, default=0, nullable=False)
+    changed = Column(Integer, default=0, nullable=False)
+    errors = Column(Integer, default=0, nullable=False)
+
+
+class PendingNotification(Base):
+    __tablename__ = "pending_notifications"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String, nullable=False)
+    username = Column(String, nullable=False)
+    old_rating = Column(Integer)
+    new_rating = Column(Integer)
+
+
+def get_sweep_state(session) -> SweepState:
+    state = session.get(SweepState, 1)
+    if state is None:
+        state = SweepState(id=1, checked=0, changed=0, errors=0)
+        session.add(state)
+        session.flush()
+    return state
+
+
 def _sqlite_url(path: Path | str) -> str:
     path_str = str(path)
     return f"sqlite:///{path_str}"
@@ -84,6 +115,24 @@ def _ensure_schema(engine) -> None:
             conn.execute(text("ALTER TABLE chats ADD COLUMN last_name VARCHAR"))
 
 
+def _ensure_outbox_autoincrement(engine) -> None:
+    with engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT sql FROM sqlite_master WHERE type='table' AND name='pending_notifications'")
+        ).fetchone()
+        if not row or "AUTOINCREMENT" in row[0].upper():
+            return
+        conn.execute(text("ALTER TABLE pending_notifications RENAME TO pending_notifications_old"))
+        PendingNotification.__table__.create(conn)
+        conn.execute(
+            text(
+                "INSERT INTO pending_notifications (id, chat_id, username, old_rating, new_rating) "
+                "SELECT id, chat_id, username, old_rating, new_rating FROM pending_notifications_old"
+            )
+        )
+        conn.execute(text("DROP TABLE pending_notifications_old"))
+
+
 def get_engine(db_path: str | None = None):
     db_url = _resolve_db_url(db_path)
     connect_args = {"check_same_thread": False} if db_url.startswith("sqlite") else {}
@@ -91,8 +140,21 @@ def get_engine(db_path: str | None = None):
 
 
 def init_db(db_path: str | None = None):
-    engine = get_engine(db_path)
+    return sessionmaker(bind=get_engine(db_path))
+
+
+def migrate_db(session_factory) -> bool:
+    engine = session_factory.kw["bind"]
+    if engine.dialect.name != "sqlite":
+        Base.metadata.create_all(engine)
+        return True
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar() or 0
+    if version >= SCHEMA_VERSION:
+        return False
     Base.metadata.create_all(engine)
-    if engine.dialect.name == "sqlite":
-        _ensure_schema(engine)
-    return sessionmaker(bind=engine)
+    _ensure_schema(engine)
+    _ensure_outbox_autoincrement(engine)
+    with engine.begin() as conn:
+        conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+    return True
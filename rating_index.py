@@ -0,0 +1,86 @@
+from bisect import bisect_left, bisect_right, insort
+
+from db import Chat, MonitoredUser
+
+
+class IndexEntry:
+    __slots__ = ("last_rating", "chat_ids", "baselines")
+
+    def __init__(self, last_rating: int | None, chat_ids: tuple[str, ...] = ()) -> None:
+        self.last_rating = last_rating
+        self.chat_ids = chat_ids
+        self.baselines: dict[str, int | None] | None = None
+
+    def baseline(self, chat_id: str) -> int | None:
+        if self.baselines and chat_id in self.baselines:
+            return self.baselines[chat_id]
+        return self.last_rating
+
+    def set_baseline(self, chat_id: str, rating: int | None) -> None:
+        if rating == self.last_rating:
+            if self.baselines:
+                self.baselines.pop(chat_id, None)
+            return
+        if self.baselines is None:
+            self.baselines = {}
+        self.baselines[chat_id] = rating
+
+
+class RatingIndex:
+    def __init__(self) -> None:
+        self._entries: dict[str, IndexEntry] = {}
+        self._sorted: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, username: str) -> IndexEntry | None:
+        return self._entries.get(username)
+
+    def next_after(self, username: str | None) -> str | None:
+        pos = bisect_right(self._sorted, username) if username is not None else 0
+        if pos < len(self._sorted):
+            return self._sorted[pos]
+        return None
+
+    def load(self, session_factory) -> None:
+        entries: dict[str, IndexEntry] = {}
+        session = session_factory()
+        try:
+            rows = (
+                session.query(MonitoredUser.username, MonitoredUser.last_rating, Chat.chat_id)
+                .join(Chat, MonitoredUser.chat_id == Chat.id)
+                .order_by(MonitoredUser.id)
+            )
+            for username, last_rating, chat_id in rows:
+                entry = entries.get(username)
+                if entry is None:
+                    entries[username] = IndexEntry(last_rating, (chat_id,))
+                    continue
+                entry.chat_ids += (chat_id,)
+                entry.set_baseline(chat_id, last_rating)
+        finally:
+            session.close()
+        self._entries = entries
+        self._sorted = sorted(entries)
+
+    def add(self, username: str, chat_id: str, rating: int | None) -> None:
+        entry = self._entries.get(username)
+        if entry is None:
+            self._entries[username] = IndexEntry(rating, (chat_id,))
+            insort(self._sorted, username)
+            return
+        if chat_id not in entry.chat_ids:
+            entry.chat_ids += (chat_id,)
+        entry.set_baseline(chat_id, rating)
+
+    def remove(self, username: str, chat_id: str) -> None:
+        entry = self._entries.get(username)
+        if entry is None:
+            return
+        entry.chat_ids = tuple(c for c in entry.chat_ids if c != chat_id)
+        if entry.baselines:
+            entry.baselines.pop(chat_id, None)
+        if not entry.chat_ids:
+            del self._entries[username]
+            del self._sorted[bisect_left(self._sorted, username)]
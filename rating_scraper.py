@@ -1,11 +1,16 @@
 import asyncio
 import logging
-
-import requests
-from bs4 import BeautifulSoup
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 logger = logging.getLogger(__name__)
 
+HTML_PARSE_WORKERS = int(os.getenv("HTML_PARSE_WORKERS", "0"))
+
+_parser_pool: ProcessPoolExecutor | None = None
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36",
     "Accept": "application/json, text/plain, */*",
@@ -19,6 +24,8 @@ def _text_snippet(text: str, limit: int = 200) -> str:
 
 
 async def _fetch_json(url: str, username: str, params: dict | None = None) -> dict | None:
+    import requests
+
     try:
         response = await asyncio.to_thread(
             requests.get,
@@ -109,7 +116,72 @@ async def _get_rating_api(username: str) -> int | None:
         return None
 
 
+def _parse_rating_html(
+    content: bytes, encoding: str | None = None
+) -> tuple[int | None, str | None, str | None]:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(content, "html.parser", from_encoding=encoding)
+    img = soup.find("img", alt="Рейтинг")
+    if not img:
+        return None, "missing_img", None
+    container = img.find_parent("div")
+    if not container:
+        return None, "missing_container", None
+    rating_div = container.find_next_sibling("div")
+    if not rating_div:
+        return None, "missing_value", None
+    text = rating_div.get_text(strip=True)
+    try:
+        return int(text), None, None
+    except ValueError:
+        return None, "invalid_value", text
+
+
+def _get_parser_pool() -> ProcessPoolExecutor | None:
+    global _parser_pool
+    if HTML_PARSE_WORKERS <= 0:
+        return None
+    if _parser_pool is None:
+        _parser_pool = ProcessPoolExecutor(
+            max_workers=HTML_PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+    return _parser_pool
+
+
+def start_parser_pool() -> None:
+    pool = _get_parser_pool()
+    if pool is not None:
+        pool.submit(int).result()
+
+
+def shutdown_parser_pool() -> None:
+    global _parser_pool
+    if _parser_pool is not None:
+        _parser_pool.shutdown(wait=False, cancel_futures=True)
+        _parser_pool = None
+
+
+async def _parse_rating(
+    content: bytes, encoding: str | None
+) -> tuple[int | None, str | None, str | None]:
+    pool = _get_parser_pool()
+    if pool is None:
+        return _parse_rating_html(content, encoding)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, _parse_rating_html, content, encoding
+        )
+    except BrokenProcessPool:
+        if _parser_pool is pool:
+            shutdown_parser_pool()
+        raise
+
+
 async def _get_rating_html(username: str) -> int | None:
+    import requests
+
     url = f"https://hackerlab.pro/users/{username}"
     html_headers = dict(HEADERS)
     html_headers["Accept"] = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
@@ -131,47 +203,46 @@ async def _get_rating_html(username: str) -> int | None:
             response.status_code,
         )
         return None
-    soup = BeautifulSoup(response.text, "html.parser")
-    img = soup.find("img", alt="Рейтинг")
-    if not img:
+    try:
+        declared = "charset" in response.headers.get("content-type", "").lower()
+        rating, failure, text = await _parse_rating(
+            response.content, response.encoding if declared else None
+        )
+    except Exception as exc:
         logger.warning(
-            "rating_parse_missing_img: username=%s url=%s html_len=%s html_snippet=%s",
+            "rating_parse_failed: username=%s url=%s error=%s",
             username,
             url,
-            len(response.text),
-            _text_snippet(response.text),
+            exc,
         )
         return None
-    container = img.find_parent("div")
-    if not container:
+    if failure is None:
+        return rating
+    if failure == "missing_img":
         logger.warning(
-            "rating_parse_missing_container: username=%s url=%s html_snippet=%s",
+            "rating_parse_missing_img: username=%s url=%s html_len=%s html_snippet=%s",
             username,
             url,
+            len(response.text),
             _text_snippet(response.text),
         )
-        return None
-    rating_div = container.find_next_sibling("div")
-    if not rating_div:
+    elif failure == "invalid_value":
         logger.warning(
-            "rating_parse_missing_value: username=%s url=%s html_snippet=%s",
+            "rating_parse_invalid_value: username=%s url=%s text=%s html_snippet=%s",
             username,
             url,
+            text,
             _text_snippet(response.text),
         )
-        return None
-    text = rating_div.get_text(strip=True)
-    try:
-        return int(text)
-    except ValueError:
+    else:
         logger.warning(
-            "rating_parse_invalid_value: username=%s url=%s text=%s html_snippet=%s",
+            "rating_parse_%s: username=%s url=%s html_snippet=%s",
+            failure,
             username,
             url,
-            text,
             _text_snippet(response.text),
         )
-        return None
+    return None
 
 
 async def get_rating(username: str) -> int | None: